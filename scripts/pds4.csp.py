@@ -73,17 +73,69 @@ Optional:
                        {end_year} = ending year of the file
                         {end_doy} = ending day of year of the file
                   for example, "dawnvegr_{start_year}_{start_doy}.csp"
+   --hash <md5|blake3>, checksum algorithm, default md5. md5 fills <md5_checksum>,
+                  blake3 fills a <file_hash> element, which the template must have, and
+                  blanks <md5_checksum> so the template's value is not left behind
 
 """
 
 import os
 import sys
+import mmap
 from argparse import ArgumentParser
 from datetime import datetime
 import shutil
 from pds4.template import XML_Template
 import pds4.util as util
 
+def _parse_csp_ts( b ):
+   """ parse a CSP timestamp YY/MM/DD,HH:MM[:SS[.ffffff]] given as bytes.
+       the layout is fixed, so slice out the fields rather than use strptime,
+       after checking the layout so that malformed stamps are still rejected """
+   n = len(b)
+   fields = [ b[0:2], b[3:5], b[6:8], b[9:11], b[12:14] ]
+   if n >= 17:
+      fields.append( b[15:17] )
+   if n >= 19:
+      fields.append( b[18:] )
+   if not ( n in (14, 17) or 19 <= n <= 24 ) or \
+      b[2:3] != b'/' or b[5:6] != b'/' or b[8:9] != b',' or b[11:12] != b':' or \
+      ( n >= 17 and b[14:15] != b':' ) or ( n >= 19 and b[17:18] != b'.' ) or \
+      not all( f.isdigit() for f in fields ):
+      raise ValueError('Invalid CSP timestamp %s, expected YY/MM/DD,HH:MM[:SS[.ffffff]]' % b.decode(errors='replace'))
+
+   year = int(b[0:2])
+   year = year + (2000 if year < 69 else 1900)   # same pivot as strptime's %y
+   second = int(b[15:17]) if n >= 17 else 0
+   microsecond = int(b[18:24].ljust(6, b'0')) if n > 18 else 0
+   return datetime( year, int(b[3:5]), int(b[6:8]), int(b[9:11]), int(b[12:14]), second, microsecond )
+
+def _find_ts( mm, key, reverse=False ):
+   """ return the bytes inside KEY(...) for the first occurrence of key in mm,
+       or the last one if reverse is set, e.g. key=b'FROM(' for FROM(14/01/01,00:00).
+       the key must start a token, so that e.g. AUTO( is not taken for TO(, and
+       the closing parenthesis must be on the same line """
+   i = mm.rfind(key) if reverse else mm.find(key)
+   while i > 0 and (mm[i-1:i].isalnum() or mm[i-1:i] == b'_'):
+      i = mm.rfind(key, 0, i) if reverse else mm.find(key, i+1)
+   stop = -1
+   if i >= 0:
+      # the closing parenthesis must be on the same line
+      start = i + len(key)
+      eol = mm.find(b'\n', start)
+      stop = mm.find(b')', start, eol if eol >= 0 else len(mm))
+   if stop < 0:
+      raise ValueError('No %s...) found in the CSP file' % key.decode())
+   return mm[start:stop]
+
+def _count_lines( mm, blocksize=1<<20 ):
+   """ count the newlines in a mapped file, a block at a time
+       (mmap.count is not available before python 3.13) """
+   n = 0
+   for i in range(0, len(mm), blocksize):
+      n = n + mm[i:i+blocksize].count(b'\n')
+   return n
+
 def main( args ):
    """ Main program function. This is the first executed code,
        and contains the necessary argument parsing and dump functions """
@@ -91,67 +143,67 @@ def main( args ):
    # Get the WEA file we're working with
    csp_file = args.Input
 
-   # Loop through and parse the records
-   # Load file line by line
-   data = []
-   n_records = 0
-   first = False
-   with open(csp_file, 'r') as f:
-      for line in f:
-         if 'FROM' in line and not first:
-            s = line.find('FROM(')
-            e = s + line[s:].find(')')
-            tstr = line[s+5:e]
-            if len(tstr) == 14: 
-               fmt = '%y/%m/%d,%H:%M'
-            elif len(tstr) == 17:
-               fmt = '%y/%m/%d,%H:%M:%S'
-            else: 
-               fmt = '%y/%m/%d,%H:%M:%S.%f'
-            start_time = datetime.strptime( tstr, fmt )
-            first = True
-         if 'TO' in line:
-            s = line.find('TO(')
-            e = s + line[s:].find(')')
-            tstr = line[s+3:e]
-            if len(tstr) == 14: 
-               fmt = '%y/%m/%d,%H:%M'
-            elif len(tstr) == 17:
-               fmt = '%y/%m/%d,%H:%M:%S'
-            else: 
-               fmt = '%y/%m/%d,%H:%M:%S.%f'
-            end_time = datetime.strptime( tstr, fmt )
-         n_records = n_records + 1
+   # Read template. a checksum other than MD5 needs somewhere to go in the label
+   Template = XML_Template( args.template )
+   if args.hash != 'md5' and not Template.has('<file_hash>'):
+      raise ValueError('Template ' + args.template + ' has no <file_hash> element for the ' + args.hash +
+                       ' checksum. Use --hash md5 or add <file_hash> to the template.')
+
+   # Map the file once: size, hash, first FROM(...) and last TO(...) timestamps
+   # and the record count all come from the same mapping
+   with open(csp_file, 'rb', buffering=0) as f:
+      with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+         file_size = len(mm)
+         checksum = util.file_hash( mm, args.hash )
+
+         # The first FROM( is at the start of the file and the last TO( at the end,
+         # so search forwards for one and backwards for the other, touching only
+         # the bytes on either end
+         start_time = _parse_csp_ts( _find_ts(mm, b'FROM(') )
+         end_time = _parse_csp_ts( _find_ts(mm, b'TO(', reverse=True) )
+
+         # One record per line, including a final line without a newline
+         n_records = _count_lines( mm )
+         if len(mm) > 0 and mm[-1:] != b'\n':
+            n_records = n_records + 1
+
+   # Format the times once, for both the renaming and the label
+   start = { fmt: start_time.strftime(fmt) for fmt in ('%Y', '%j', '%H%M', '%Y-%m-%dT%H:%M:%SZ') }
+   end = { fmt: end_time.strftime(fmt) for fmt in ('%Y', '%j', '%Y-%m-%dT%H:%M:%SZ') }
 
    # Rename the CSP file if necessary, and change the name of the TNF file in the label
    if args.rename is not None:
-      csp_new_name = args.rename.format( start_year = start_time.strftime('%Y'),
-                                            start_doy = start_time.strftime('%j'),
-                                            start_time = start_time.strftime('%H%M'),
-                                            end_year = end_time.strftime('%Y'),
-                                            end_doy = end_time.strftime('%j') )
+      fmt_ctx = { 'start_year': start['%Y'],
+                  'start_doy': start['%j'],
+                  'start_time': start['%H%M'],
+                  'end_year': end['%Y'],
+                  'end_doy': end['%j'] }
+      csp_new_name = args.rename.format_map( fmt_ctx )
       os.rename( csp_file, csp_new_name )
       csp_file = csp_new_name
 
-   # Read template
-   Template = XML_Template( args.template )
-
    # form new logical identifier
    file_base = os.path.basename( csp_file ).split('.')[0]
    lid = Template.read('<logical_identifier>').rsplit(':',1)[0] + ':' + file_base
 
-   # Fill the label with information
-   Template.replace( '<logical_identifier>', lid )
-   Template.replace( '<modification_date>', datetime.now().strftime('%Y-%m-%d') )
-   Template.replace( '<start_date_time>', start_time.strftime('%Y-%m-%dT%H:%M:%SZ') )
-   Template.replace( '<stop_date_time>', end_time.strftime('%Y-%m-%dT%H:%M:%SZ') )
-   Template.replace( '<file_name>', csp_file )
-   Template.replace( '<local_identifier>', file_base )
-   Template.replace( '<creation_date_time>', end_time.strftime('%Y-%m-%dT%H:%M:%SZ') )
-   Template.replace( '<md5_checksum>', util.md5hashfile(csp_file) )
-   Template.replace( '<file_size unit="byte">', str(os.path.getsize(csp_file)) )
-   Template.replace( '<records>', str(n_records), True )
-   
+   # Fill the label with information. with another checksum the template's MD5 is blanked,
+   # so the label never carries a stale one
+   if args.hash == 'md5':
+      checksums = { '<md5_checksum>': checksum }
+   else:
+      checksums = { '<file_hash>': checksum, '<md5_checksum>': '' }
+   Template.replace_many( { '<logical_identifier>': lid,
+                            '<modification_date>': datetime.now().strftime('%Y-%m-%d'),
+                            '<start_date_time>': start['%Y-%m-%dT%H:%M:%SZ'],
+                            '<stop_date_time>': end['%Y-%m-%dT%H:%M:%SZ'],
+                            '<file_name>': csp_file,
+                            '<local_identifier>': file_base,
+                            '<creation_date_time>': end['%Y-%m-%dT%H:%M:%SZ'],
+                            **checksums,
+                            '<file_size unit="byte">': str(file_size),
+                            '<records>': str(n_records) },
+                          replace_one=('<records>',) )
+
    # Write label
    out_filename = util.label_filename( csp_file )
    Template.write( out_filename )
@@ -177,6 +229,10 @@ if __name__ == "__main__":
                              ' {start_time} = starting time of file (UTC)          ' + \
                              ' {end_year} = ending year of the file                ' + \
                              ' {end_doy} = ending day of year of the file          ' )
+   parser.add_argument( '--hash', dest='hash', default='md5', choices=util.HASH_ALGORITHMS,
+                        help='checksum algorithm. md5 fills <md5_checksum>, any other fills a ' + \
+                             '<file_hash> element, which the template must have, and blanks ' + \
+                             '<md5_checksum> (blake3 needs the blake3 package)' )
 
    # Parse the command line automatically
    args = parser.parse_args()
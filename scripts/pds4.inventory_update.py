@@ -67,6 +67,7 @@ import os
 import sys
 from argparse import ArgumentParser
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from pds4.template import XML_Template
 import pds4.util as util
 
@@ -77,6 +78,14 @@ MOD_HISTORY_TEMPLATE = """            <Modification_Detail>
             </Modification_Detail>
 """
 
+def _extract_lid_version( filename ):
+   """ read the logical identifier and version of a label as LID::VID, in one pass """
+   tags = util.extract_tags( filename, ('logical_identifier', 'version_id') )
+   for tag in ('logical_identifier', 'version_id'):
+      if not tags.get(tag):
+         raise ValueError('Label ' + filename + ' has no <' + tag + '> value')
+   return tags['logical_identifier'] + '::' + tags['version_id']
+
 def main( args ):
    """ Main program function. This is the first executed code,
        and contains the necessary argument parsing and dump functions """
@@ -84,47 +93,44 @@ def main( args ):
    # ------------------------------------------------------------------------
    # Get a list of logicial identifiers
 
-   identifiers = []
-   for filename in args.Input:
-      # Read the logicial identifier
-      Template = XML_Template( filename )
-      lid = Template.read('<logical_identifier>')
-      version = Template.read('<version_id>','first')
-      identifiers.append(lid+'::'+version)
+   # Each label is read independently, so overlap the reads. map() keeps the input order
+   with ThreadPoolExecutor( max_workers=min(32, len(args.Input)) ) as executor:
+      identifiers = list( executor.map(_extract_lid_version, args.Input) )
    print( "Found a total of %d logical identifiers in the provided files." % len(identifiers) )
 
    # Get the current number of records in the csv file
    collection_filename = args.collection
    collection_label_filename = util.label_filename( collection_filename )
+
    Template = XML_Template( collection_label_filename )
-   n = int( Template.read('<records>') ) 
+   n = int( Template.read('<records>') )
    version = Template.read('<version_id>', 'all')
    if len(version) < 2:
-      IOError("ERROR: This collection is missing entries to <version_id>")
-   current_version = version[0]
-   version = [ float(v) for v in version[1:] ]
+      raise IOError("ERROR: This collection is missing entries to <version_id>")
    mod_date = Template.read('<modification_date>', 'all')
-   if len(mod_date) != len(version):
-      IOError("ERROR: Invalid syntax in <Modification_History>, check the collection xml label...")
-   num_modifications = len(version)
+   if len(mod_date) != len(version) - 1:
+      raise IOError("ERROR: Invalid syntax in <Modification_History>, check the collection xml label...")
+
+   # Last and highest version in the modification history (the first <version_id> is the label's own)
+   last_version = float( version[-1] )
+   max_version = max( float(v) for v in version[1:] )
+   num_modifications = len(version) - 1
    print( "This file has been modified %d times" % num_modifications )
-   print( "The last modification date was %s with version id %.1f" % (mod_date[-1], version[-1]) )
+   print( "The last modification date was %s with version id %.1f" % (mod_date[-1], last_version) )
    print( "The label says there are currently %s records in the collection." % str(n) )
 
-   # Write the new records to CSV file
-   fid = open( collection_filename, 'w' )
+   # Write the new records to CSV file, appended to the current records if keeping them
    if args.keep:
-      fid.write( ''.join(data) )
       count = n + len(identifiers)
    else:
       count = len(identifiers)
-   for lid in identifiers:
-      outstr = "P,%s\r\n" % lid
-      fid.write(outstr)
-   fid.close()
+   # (LIDs are ASCII by the PDS4 standard, so build the rows as bytes and write them in one call)
+   out = b''.join( b'P,' + lid.encode('ascii') + b'\r\n' for lid in identifiers )
+   with open( collection_filename, 'ab' if args.keep else 'wb' ) as fid:
+      fid.write( out )
 
    # Add new modification History
-   next_version = max(version) + 1
+   next_version = max_version + 1
    mod_detail = MOD_HISTORY_TEMPLATE.format( modification_date = datetime.now().strftime('%Y-%m-%d'),
                                              version_id = '%.1f' % next_version,
                                              description = args.message )
@@ -69,63 +69,89 @@ Optional:
                       {ul_dss_id} = uplink DSS ID. If there are multiple, will print "MM"
                     {uplink_band} = downlink band.
                              {bw} = recording bandwith in kHz, zero-padded to 3 digits
+   --hash <md5|blake3>, checksum algorithm, default md5. md5 fills <md5_checksum>,
+                  blake3 fills a <file_hash> element, which the template must have, and
+                  blanks <md5_checksum> so the template's value is not left behind
 
 """
 
 import os
 from datetime import datetime
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 
 import rdef_0222sci
 import pds4.util as util
 from pds4.template import XML_Template
 
+def _size_and_hash(filename, algo):
+    """ size and checksum of a file, from a single open """
+    with open( filename, 'rb' ) as f:
+        return os.fstat( f.fileno() ).st_size, util.file_hash( f, algo )
+
 def main(args):
     """ main program function """
     
-    # Open OLR file and get the required information
-    reader = rdef_0222sci.Reader( args.Input )
-    info = rdef_0222sci.Info( reader )
+    # Open template. a checksum other than MD5 needs somewhere to go in the label
+    Template = XML_Template( args.template )
+    if args.hash != 'md5' and not Template.has('<file_hash>'):
+        raise ValueError('Template ' + args.template + ' has no <file_hash> element for the ' + args.hash +
+                         ' checksum. Use --hash md5 or add <file_hash> to the template.')
+    
+    # Open OLR file and get the required information. The reader does its own IO, so
+    # hash the file in the background while it goes through the file, while both
+    # passes are still warm in the page cache
+    with ThreadPoolExecutor( max_workers=1 ) as executor:
+        pending = executor.submit( _size_and_hash, args.Input, args.hash )
+        reader = rdef_0222sci.Reader( args.Input )
+        info = rdef_0222sci.Info( reader )
+        file_size, checksum = pending.result()
     print( info )
     
-    # Rename the file if desired
+    # Format the times once, for both the renaming and the label
+    start = { fmt: info.start_time.strftime(fmt) for fmt in ('%Y', '%j', '%H%M', '%Y-%m-%dT%H:%M:%SZ') }
+    end = { fmt: info.end_time.strftime(fmt) for fmt in ('%Y-%m-%dT%H:%M:%SZ',) }
+
+    # Rename the file if desired. Uplink station: the one station, MM for several, NN for none
     if len(info.uplink_station_id) == 1:
         uplink = str(info.uplink_station_id[0])
-    elif len(info.uplink_station_id) > 1:
-        uplink = 'MM'
     else:
-        uplink = 'NN'
+        uplink = 'MM' if info.uplink_station_id else 'NN'
     if args.rename is not None:
-        new_filename = args.rename.format( start_year = info.start_time.strftime('%Y'),
-                                           start_doy = info.start_time.strftime('%j'),
-                                           start_time = info.start_time.strftime('%H%M'),
-                                           dl_dss_id = info.station_id,
-                                           dl_band = info.downlink_band,
-                                           ul_dss_id = uplink,
-                                           ul_band = info.uplink_band[0],
-                                           bw = str(info.recording_bw/1000).zfill(3) )
+        fmt_ctx = { 'start_year': start['%Y'],
+                    'start_doy': start['%j'],
+                    'start_time': start['%H%M'],
+                    'dl_dss_id': info.station_id,
+                    'dl_band': info.downlink_band,
+                    'ul_dss_id': uplink,
+                    'ul_band': info.uplink_band[0],
+                    'bw': str(info.recording_bw/1000).zfill(3) }
+        new_filename = args.rename.format_map( fmt_ctx )
         os.rename( args.Input, new_filename )
         args.Input = new_filename
         
-    # Open template
-    Template = XML_Template( args.template )
-    
     # form new logical identifier
     file_base = os.path.basename( args.Input ).split('.')[0]
     lid = Template.read('<logical_identifier>').rsplit(':',1)[0] + ':' + file_base
     
-    # Fill label with information
-    Template.replace( '<logical_identifier>', lid )
-    Template.replace( '<modification_date>', datetime.now().strftime('%Y-%m-%d') )
-    Template.replace( '<start_date_time>', info.start_time.strftime('%Y-%m-%dT%H:%M:%SZ') )
-    Template.replace( '<stop_date_time>', info.end_time.strftime('%Y-%m-%dT%H:%M:%SZ') )
-    Template.replace( '<file_name>', args.Input )
-    Template.replace( '<local_identifier>', file_base )
-    Template.replace( '<creation_date_time>', info.end_time.strftime('%Y-%m-%dT%H:%M:%SZ') )
-    Template.replace( '<md5_checksum>', util.md5hashfile(args.Input) )
-    Template.replace( '<file_size unit="byte">', str(os.path.getsize(args.Input)) )
-    Template.replace( '<record_length unit="byte">', str(info.record_length) )
-    Template.replace( '<records>', str(info.num_records), True )
+    # Fill label with information. with another checksum the template's MD5 is blanked,
+    # so the label never carries a stale one
+    if args.hash == 'md5':
+        checksums = { '<md5_checksum>': checksum }
+    else:
+        checksums = { '<file_hash>': checksum, '<md5_checksum>': '' }
+    Template.replace_many( { '<logical_identifier>': lid,
+                             '<modification_date>': datetime.now().strftime('%Y-%m-%d'),
+                             '<start_date_time>': start['%Y-%m-%dT%H:%M:%SZ'],
+                             '<stop_date_time>': end['%Y-%m-%dT%H:%M:%SZ'],
+                             '<file_name>': args.Input,
+                             '<local_identifier>': file_base,
+                             '<creation_date_time>': end['%Y-%m-%dT%H:%M:%SZ'],
+                             **checksums,
+                             '<file_size unit="byte">': str(file_size),
+                             '<record_length unit="byte">': str(info.record_length),
+                             '<records>': str(info.num_records) },
+                           replace_one=('<records>',) )
     
     # Do something here about 16bit/8bit record
     if info.bits !=  16:
@@ -156,6 +182,10 @@ if __name__ == '__main__':
              '  {bw} = recording bandwith in kHz, zero-padded to 3 digits  ')
     parser.add_argument('-t','--template',dest='template', type=str, required=True,
         help='Location of the XML label template to use')
+    parser.add_argument('--hash', dest='hash', default='md5', choices=util.HASH_ALGORITHMS,
+        help='checksum algorithm. md5 fills <md5_checksum>, any other fills a ' + \
+             '<file_hash> element, which the template must have, and blanks ' + \
+             '<md5_checksum> (blake3 needs the blake3 package)')
 
     # Parse
     args = parser.parse_args()
@@ -59,6 +59,7 @@ Last Modified: 14-SEP-2023
 Synopsis::
 
    pds4.trk234.py -c <config_dir> -t <XML_template> [options] <tnf_file>
+   pds4.trk234.py -c <config_dir> -t <XML_template> [options] -b <file_list>
 
 Options::
 
@@ -79,16 +80,25 @@ Optional:
                       {ul_dss_id} = uplink DSS ID. If there are multiple, will print "MM"
                     {uplink_band} = uplink band. If there are multiple, will print "M"
                   for example, "dawnvegr_{start_year}_{start_doy}.tnf"
+   -b <file_list>, label every TNF file listed (one per line) in file_list. the
+                   templates are only read once for the whole batch
    -v, validate the output file using the PDS4 validate software
    -o, keep original TNF file (do not sort the file by SFDU type - NOT RECOMMENDED)
+   --keep-original, when sorting, keep a copy of the unsorted TNF file as <tnf_file>.original
    -q, quick version. okay for very large (>1GB), predictable (single-spacecraft) TNF files
+   --no-checksum, do not compute the MD5 checksum. <md5_checksum> is left blank
+   --progress/--no-progress, show the decoding progress (default: only on a terminal)
 
 """
 
 # Required imports
 import os
 import sys
-from argparse import ArgumentParser
+import copy
+import shutil
+import subprocess
+import tempfile
+from argparse import ArgumentParser, ArgumentTypeError, BooleanOptionalAction
 from datetime import datetime
 import trk234
 import pds4.util as util
@@ -97,20 +107,45 @@ from pds4.template import XML_Template
 # Define the default configuraiton directory
 DEFAULT_CONFIG_DIR = os.getenv('RS_TRK234_DEFAULT_CONFIG')
 
+# Data types that may only contain one observation per SFDU, and the
+# label.sfdu_length that implies
+SINGLE_OBSERVATION_LENGTH = { 16: 200, 17: 216 }
+
+# Parsed XML templates by absolute path, shared by every label made in this process
+TEMPLATE_POOL = {}
+
+def load_template( filename, hot_tags=() ):
+   """ return a copy of the XML template in filename, which is only read and
+       parsed the first time it is asked for. the copy can be modified freely """
+   path = os.path.abspath( filename )
+   if path not in TEMPLATE_POOL:
+      TEMPLATE_POOL[path] = XML_Template( path, hot_tags )
+   return copy.deepcopy( TEMPLATE_POOL[path] )
+
+def template_argument( filename ):
+   """ argparse type for the label template, which is read and parsed once
+       while the arguments are parsed. each Label works on its own copy """
+   if not os.path.exists( filename ):
+      raise ArgumentTypeError( 'Template file %s does not exist' % filename )
+   return XML_Template( filename )
+
 class Label:
    """
    The basic class that will generate a label for a given TNF file
    """
 
-   def __init__(self, tnf_file, label_template, config_directory, quick=False):
+   def __init__(self, tnf_file, label_template, config_directory, quick=False, progress=True):
       """ Class constructor """
 
       # Save the TNF file name and configuration directory
-      self.filename = tnf_file
-      self.config_dir = config_directory
+      self.set_filename( tnf_file )
+      self.config_dir = os.path.abspath( config_directory )
 
-      # Load the template
-      self.Template = XML_Template( label_template )
+      # Load the template, unless it was already loaded
+      if isinstance( label_template, XML_Template ):
+         self.Template = copy.deepcopy( label_template )
+      else:
+         self.Template = load_template( label_template )
 
       # Load the TNF file and parse the SFDUs (exept tracking chdo to save speed)
       self.tnf = trk234.Reader( tnf_file )
@@ -118,63 +153,66 @@ class Label:
          self.trk234_info = trk234.Info( self.tnf, True )
          print( "Using `quick` option! Some checks are NOT done and assumptions ARE made. Manually check the label." )
       else:
-         self.tnf.decode( trk_chdo=False, progress=True )
+         self.tnf.decode( trk_chdo=False, progress=progress )
          self.trk234_info = trk234.Info( self.tnf )
 
          # Validate the TNF type 16 and 17. They must contain only ***ONE*** observation or else
          # we cannot label them! Very important!
          for s in self.tnf.sfdu_list:
-            if s.pri_chdo.format_code == 16:
-               if s.label.sfdu_length != 200:
-                  ValueError('File ' + self.filename + ' contains a DT16 with more than one observation.\n' +
-                             'Expected label.sfdu_length = 200, actual label.sfdu_length = %i' % s.label.sfdu_length )
-            if s.pri_chdo.format_code == 17:
-               if s.label.sfdu_length != 216:
-                  ValueError('File ' + self.filename + ' contains a DT17 with more than one observation.\n' +
-                             'Expected label.sfdu_length = 216, actual label.sfdu_length = %i' % s.label.sfdu_length )
-
-      # Load the configuration files
-      self.tableTemplate = []
-      for i in range(0,18):
-         fn = os.path.abspath( config_directory ) + os.sep + 'trk_TableBinary_SFDU_%02i.xml' % i
-         self.tableTemplate.append( XML_Template( fn ) )
+            expected = SINGLE_OBSERVATION_LENGTH.get( s.pri_chdo.format_code )
+            if expected is not None and s.label.sfdu_length != expected:
+               raise ValueError('File ' + self.filename + ' contains a DT%i with more than one observation.\n' % s.pri_chdo.format_code +
+                                'Expected label.sfdu_length = %i, actual label.sfdu_length = %i' % (expected, s.label.sfdu_length) )
+
+      # The configuration files are loaded when first needed, by data type
+      self.tableTemplate = {}
 
    def __str__(self):
       """ convert this class to a string for printing """
       return str(self.Template)
 
-   def fill(self):
-      """ rewrite the template with updated information based on the TNF """
-
-      # Replace the unique LID reference
-      file_base = os.path.basename( self.filename ).split('.')[0].lower()
+   def set_filename(self, tnf_file):
+      """ set the TNF file name, e.g. after renaming the file, and cache
+          its stat result, base name and absolute path for the label """
+      self.filename = tnf_file
+      self.stat = os.stat( tnf_file )
+      self.basename = os.path.basename( tnf_file )
+      self.abspath = os.path.abspath( tnf_file )
+
+   def _get_template(self, i):
+      """ return the table template for SFDU data type i, loading it from the
+          configuration directory the first time it is used """
+      if i not in self.tableTemplate:
+         fn = os.path.join( self.config_dir, 'trk_TableBinary_SFDU_%02i.xml' % i )
+         self.tableTemplate[i] = load_template( fn, hot_tags=('<record_length unit="byte">',) )
+      return self.tableTemplate[i]
+
+   def fill(self, checksum=True):
+      """ rewrite the template with updated information based on the TNF. with
+          checksum=False the MD5 checksum is not computed and <md5_checksum> is
+          blanked, so the label never carries the template's stale value """
+
+      # Form the unique LID reference
+      file_base = self.basename.split('.')[0].lower()
       lid = self.Template.read('<logical_identifier>').rsplit(':',1)[0] + ':' + file_base.lower()
-      self.Template.replace( '<logical_identifier>', lid )
-
-      # Replace the modification date
-      self.Template.replace( '<modification_date>', datetime.now().strftime('%Y-%m-%d') )
-
-      # Replace the applicable start time
-      self.Template.replace( '<start_date_time>', self.trk234_info.startTime.strftime('%Y-%m-%dT%H:%M:%SZ') )
-
-      # Replace the applicable stop time
-      self.Template.replace( '<stop_date_time>', self.trk234_info.endTime.strftime('%Y-%m-%dT%H:%M:%SZ') )
-
-      # Replace the file name
-      self.Template.replace( '<file_name>', os.path.basename(self.filename) )
-
-      # Replace the creation date
-#      self.Template.replace( '<creation_date_time>', self.trk234_info.lastModified.strftime('%Y-%m-%dT%H:%M:%SZ') )
-      self.Template.replace( '<creation_date_time>', self.trk234_info.endTime.strftime('%Y-%m-%dT%H:%M:%SZ') )
-
-      # Replace the file size
-      self.Template.replace( '<file_size unit="byte">', str(os.path.getsize(self.filename)) )
-
-      # Replace the number of records - the first instance in the file
-      self.Template.replace( '<records>', str(self.trk234_info.numRecords), True )
 
-      # Replace the MD5 checksum
-      self.Template.replace( '<md5_checksum>', util.md5hashfile(self.filename) )
+      # Replace the LID, modification date, start/stop times, file name, creation date,
+      # file size, number of records (the first instance in the file) and MD5 checksum
+      # in a single pass over the template. (creation date used to be trk234_info.lastModified)
+      replacements = { '<logical_identifier>': lid,
+                       '<modification_date>': datetime.now().strftime('%Y-%m-%d'),
+                       '<start_date_time>': self.trk234_info.startTime.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                       '<stop_date_time>': self.trk234_info.endTime.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                       '<file_name>': self.basename,
+                       '<creation_date_time>': self.trk234_info.endTime.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                       '<file_size unit="byte">': str(self.stat.st_size),
+                       '<records>': str(self.trk234_info.numRecords) }
+      if checksum:
+         replacements['<md5_checksum>'] = util.md5hashfile(self.filename)
+      else:
+         replacements['<md5_checksum>'] = ''
+         print( "Not computing the MD5 checksum! <md5_checksum> is left blank, the label has no valid checksum." )
+      self.Template.replace_many( replacements, replace_one=('<records>',) )
 
       # Print the TRK 2-34 info to the comments
       self.Template.insert( '<comment>', str(self.trk234_info), 'first' )
@@ -182,30 +220,36 @@ class Label:
       # Determine the number of each SFDU, and modify the label appropriately
       # --- THIS ASSUMES YOU'VE ALREADY REGROUPED THE SFDUs ---
       byte_location = 0
+      tables = []
       for i in self.trk234_info.dataTypes:
 
          # Number of SFDUs for this data type
          n_sfdus = self.trk234_info.numberDataTypes[i]
 
          # Read number of bits from the XML template for the data type
-         n_bits = int( self.tableTemplate[i].read('<record_length unit="byte">') )
-
-         # Replace the current byte offset in the template
-         self.tableTemplate[i].replace( '<offset unit="byte">', str(byte_location) )
+         table_template = self._get_template(i)
+         n_bits = int( table_template.read_cached('<record_length unit="byte">') )
 
-         # Replace number of records
-         self.tableTemplate[i].replace( '<records>', str(n_sfdus), True )
-#         self.tableTemplate[i].replace( '<groups>', str(n_sfdus), True )
-         self.tableTemplate[i].replace( '<groups>', '0', True )
+         # Replace the current byte offset and the number of records in the template
+         # (groups used to be str(n_sfdus))
+         table_template.replace_many( { '<offset unit="byte">': str(byte_location),
+                                        '<records>': str(n_sfdus),
+                                        '<groups>': '0' },
+                                      replace_one=('<records>', '<groups>') )
 
          # Update byte location
          byte_location = byte_location + n_bits * n_sfdus
 
-         # Insert into the template
-         if any('<Table_Binary>' in x for x in self.Template.data):
-            self.Template.insert( '</Table_Binary>', self.tableTemplate[i].data ,'last' )
-         else:
-            self.Template.insert( '</File>', self.tableTemplate[i].data, 'last' )
+         # Queue it up for the template
+         tables.extend( table_template.data )
+
+      # Insert all of the tables into the template at once, after the last table if there
+      # is one. (each table ends with its </Table_Binary>, so this is the same as inserting
+      # them one by one after the last </Table_Binary>)
+      if self.Template.has('<Table_Binary>'):
+         self.Template.insert( '</Table_Binary>', tables, 'last' )
+      else:
+         self.Template.insert( '</File>', tables, 'last' )
 
    def write(self, out_filename):
       """ write template to file """
@@ -213,46 +257,69 @@ class Label:
 
 # ---------------------------------------------------------------------------
 
-def main():
-   """ Main program function. This is the first executed code,
-       and contains the necessary argument parsing and dump functions """
-
-   # Get the TNF file we're working with
-   tnf_file = args.Input
+def label_tnf( tnf_file ):
+   """ sort (optionally), rename (optionally) and label a single TNF file """
 
    # sort the TRK 2-34 file and re-write as new filename
    if args.sort:
-      # sort, rename, rename: output = sorted TNF of same name, original TNF appended with '.original'
+      # sort into a temporary file next to the TNF (so it is on the same device), then move
+      # it over the TNF. with --keep-original the unsorted TNF is appended with '.original'
       print( "Sorting the TRK-2-34 file by data type in ascending order..." )
-      os.system( 'trk234_regroup ' + tnf_file + ' ' + tnf_file + '.sorted' )
-      os.rename( tnf_file, tnf_file + '.original' )
-      os.rename( tnf_file + '.sorted', tnf_file )
-      
+      fd, sorted_file = tempfile.mkstemp( dir=os.path.dirname(os.path.abspath(tnf_file)), suffix='.sorted' )
+      os.close( fd )
+      try:
+         subprocess.run( ['trk234_regroup', tnf_file, sorted_file], check=True )
+         shutil.copymode( tnf_file, sorted_file )
+         if args.keep_original:
+            # link (or copy, where links are not supported) rather than rename, so the
+            # TNF stays in place if the replace below fails
+            original_file = tnf_file + '.original'
+            if os.path.exists( original_file ):
+               os.remove( original_file )
+            try:
+               os.link( tnf_file, original_file )
+            except OSError:
+               shutil.copy2( tnf_file, original_file )
+         os.replace( sorted_file, tnf_file )
+      except BaseException:
+         if os.path.exists( sorted_file ):
+            os.remove( sorted_file )
+         raise
 
    # Initalize label creation and load the TNF file into memory
-   label = Label( tnf_file, args.template, args.config, args.quick )
+   label = Label( tnf_file, args.template, args.config, args.quick, args.progress )
 
    # Rename the TNF file if necessary, and change the name of the TNF file in the label
    if args.rename is not None:
-      tnf_new_name = args.rename.format( start_year=label.trk234_info.startTime.strftime('%Y') ,
-                                         start_doy=label.trk234_info.startTime.strftime('%j'),
-                                         start_time=label.trk234_info.startTime.strftime('%H%M'),
-                                         count_time='mmmm' if len( label.trk234_info.dopplerCountTime ) != 1 else str(int(label.trk234_info.dopplerCountTime[0])).zfill(4),
-                                         dl_dss_id='mm' if len( label.trk234_info.dnlinkDssId )!=1 else label.trk234_info.dnlinkDssId[0],
-                                         dnlink_band='m' if len( label.trk234_info.dnlinkBand )!=1 else label.trk234_info.dnlinkBand[0].lower(),
-                                         ul_dss_id='mm' if len( label.trk234_info.uplinkDssId )!=1 else label.trk234_info.uplinkDssId[0],
-                                         uplink_band='m' if len( label.trk234_info.uplinkBand )!=1 else label.trk234_info.uplinkBand[0].lower() )
+      info = label.trk234_info
+      start_year, start_doy, start_time = info.startTime.strftime('%Y %j %H%M').split()
+      tnf_new_name = args.rename.format( start_year=start_year,
+                                         start_doy=start_doy,
+                                         start_time=start_time,
+                                         count_time='mmmm' if len( info.dopplerCountTime ) != 1 else str(int(info.dopplerCountTime[0])).zfill(4),
+                                         dl_dss_id='mm' if len( info.dnlinkDssId )!=1 else info.dnlinkDssId[0],
+                                         dnlink_band='m' if len( info.dnlinkBand )!=1 else info.dnlinkBand[0].lower(),
+                                         ul_dss_id='mm' if len( info.uplinkDssId )!=1 else info.uplinkDssId[0],
+                                         uplink_band='m' if len( info.uplinkBand )!=1 else info.uplinkBand[0].lower() )
       os.rename( tnf_file, tnf_new_name )
       tnf_file = tnf_new_name
-      label.filename = tnf_new_name
+      label.set_filename( tnf_new_name )
 
    # Fill the label with information
-   label.fill()
+   label.fill( checksum=args.checksum )
 
    # Write label
-   label_file = util.label_filename( tnf_file )
+   label_file = util.label_filename( tnf_file, label.basename, label.abspath )
    label.write( label_file )
 
+def main():
+   """ Main program function. This is the first executed code,
+       and contains the necessary argument parsing and dump functions """
+
+   # Label each TNF file we're working with. the templates are shared between them
+   for tnf_file in args.files:
+      label_tnf( tnf_file )
+
 # If called as a script, go to the main() function immediately
 if __name__ == "__main__":
 
@@ -261,9 +328,11 @@ if __name__ == "__main__":
                             description='Label a DSN TRK-2-34 file with a PDS4 XML label' )
 
    # Add arguments
-   parser.add_argument( 'Input', type=str,
+   parser.add_argument( 'Input', type=str, nargs='?',
                         help='the name of the TRK-2-34 file to label' )
-   parser.add_argument( '-t', '--template', dest='template', type=str, required=True,
+   parser.add_argument( '-b', '--batch', dest='batch', type=str, default=None,
+                        help='a text file listing TRK-2-34 files to label, one per line' )
+   parser.add_argument( '-t', '--template', dest='template', type=template_argument, required=True,
                         help='the XML label template' )
 
    parser.add_argument( '-c', '--config-dir', dest='config', type=str,
@@ -283,17 +352,39 @@ if __name__ == "__main__":
                              ' {uplink_band} = uplink band (multiple = "m")         ' )
    parser.add_argument( '-o', '--original', dest='sort', default=True, action='store_false',
                         help='do not resort the TNF file (not recommended)' )
+   parser.add_argument( '--keep-original', dest='keep_original', default=False, action='store_true',
+                        help='keep the unsorted TNF file, appended with ".original"' )
    parser.add_argument( '-q', '--quick', dest='quick', default=False, action='store_true',
                         help='quick version, makes some assumptions. okay for very large, predictable files')
+   parser.add_argument( '--no-checksum', dest='checksum', default=True, action='store_false',
+                        help='do not compute the MD5 checksum of the TNF file (label-only dry run). ' + \
+                             '<md5_checksum> is left blank, so the label has no valid checksum' )
+   parser.add_argument( '--progress', dest='progress', default=None, action=BooleanOptionalAction,
+                        help='show the progress of decoding the TNF file. the default is to show it ' + \
+                             'only when the output is a terminal' )
 
    # Parse the command line automatically
    args = parser.parse_args()
 
+   # Collect the TNF files to label
+   args.files = []
+   if args.Input is not None:
+      args.files.append( args.Input )
+   if args.batch is not None:
+      if not os.path.exists( args.batch ):
+         parser.error( 'File list %s does not exist' % args.batch )
+      with open( args.batch, 'r' ) as f:
+         args.files.extend( line.strip() for line in f if line.strip() )
+   if len(args.files) == 0:
+      parser.error( 'No TRK-2-34 file given, provide Input and/or -b <file_list>' )
+
    # Error checking - does the file exist
-   if not os.path.exists( args.Input ):
-      parser.error( 'File %s does not exist' % args.Input )
-   if not os.path.exists( args.template ):
-      parser.error( 'Template file %s does not exist' % args.template )
+   for tnf_file in args.files:
+      if not os.path.exists( tnf_file ):
+         parser.error( 'File %s does not exist' % tnf_file )
+
+   if args.progress is None:
+      args.progress = sys.stdout.isatty()
 
    if not args.config:
       print( "Using default configuration directory: %s" % DEFAULT_CONFIG_DIR )
@@ -50,58 +50,141 @@ Last Modified: 14-SEP-2023
 
 """
 
+import io
+import os
+import re
+import bisect
+import shutil
+import tempfile
+import collections
+
+# Tag names in a line, with a leading '/' for closing tags
+TAG_PATTERN = re.compile( r'<(/?[A-Za-z_][\w:.-]*)' )
+
 # ---------------------------------------------------------------------------
 class XML_Template:
    """
    XML Template class, providing an interface that you can load and modify an XML file
    """
 
-   def __init__(self, filename):
-      """ class constructor. read the template file """
-      # Load the label template
-      f = open( filename, 'r' )
-      self.data = f.readlines()
-      f.close()
+   def __init__(self, filename, hot_tags=()):
+      """ class constructor. read the template file. the first values of
+          any xml strings in hot_tags are read up front for read_cached() """
+      # Load the label template with a single read, splitting it into lines
+      # with the same universal newline handling as a text mode read
+      with open( filename, 'rb' ) as f:
+         text = f.read().decode('utf-8')
+      self.data = io.StringIO( text, newline=None ).readlines()
+
+      # Map each tag name to the lines it appears on
+      self._index = collections.defaultdict(list)
+      for (index, line) in enumerate(self.data):
+         for tag in set( TAG_PATTERN.findall(line) ):
+            self._index[tag].append(index)
+
+      # Values of frequently read xml strings, until the template changes
+      self._cached = {}
+      for xml_string in hot_tags:
+         self.read_cached(xml_string)
 
    def __str__(self):
       """ convert this class to a string for printing """
       return ''.join( self.data )
 
+   def _lines(self, xml_string):
+      """ generate, in order, the indices of the lines of self.data that
+          contain xml_string. every lookup by key goes through here. keys
+          that start with a complete tag name only look at the lines that
+          tag is indexed on, anything else scans every line """
+      match = TAG_PATTERN.match(xml_string)
+      if match is not None and match.end() < len(xml_string):
+         candidates = list( self._index.get(match.group(1), ()) )
+      else:
+         candidates = range( len(self.data) )
+
+      for index in candidates:
+         if xml_string in self.data[index]:
+            yield index
+
+   def _reindex(self, index, old_line):
+      """ update the tag index after the line at index changed from old_line """
+      old_tags = set( TAG_PATTERN.findall(old_line) )
+      new_tags = set( TAG_PATTERN.findall(self.data[index]) )
+      for tag in old_tags - new_tags:
+         self._index[tag].remove(index)
+      for tag in new_tags - old_tags:
+         bisect.insort( self._index[tag], index )
+
    def replace(self, xml_string, replace_string, replace_one=False):
       """ replace the key of an XML entry matching xml_string that is
           contained in the self.data list. this function will only
           replace it if the entire key-value pair is on a single line """
 
-      # Loop through each line
-      for (index, line) in enumerate(self.data):
+      # Loop through each line containing the XML string, and replace the value
+      for index in self._lines(xml_string):
+         line = self.data[index]
+
+         # Determine start and stop index
+         start = line.find('>')
+         stop = line.rfind('<')
+
+         # Construct the new string
+         new = line[:start+1] + replace_string + line[stop:]
 
-         # If the XML string exists, replace the value
-         if xml_string in line:
+         # Replace it in template
+         self.data[index] = new
+         self._reindex(index, line)
 
-            # Determine start and stop index
-            start = line.find('>')
-            stop = line.rfind('<')
+         # Exit out of loop (replace only the first instance)
+         if replace_one:
+            break
 
-            # Construct the new string
-            new = line[:start+1] + replace_string + line[stop:]
+      self._cached.clear()
 
-            # Replace it in template
-            self.data[index] = new
+   def replace_many(self, replacements, replace_one=()):
+      """ replace several keys in a single pass over self.data.
+          replacements is a dict of {xml_string: replace_string}, with the
+          same single-line rules as replace(). keys listed in replace_one
+          are only replaced at their first instance """
 
-            # Exit out of loop (replace only the first instance)
-            if replace_one:
-               break
+      # One alternation for all keys, longest first so that a key which
+      # is a prefix of another does not win
+      keys = sorted(replacements, key=len, reverse=True)
+      pattern = re.compile( '|'.join(re.escape(k) for k in keys) )
+      done = set()
+      lines = sorted( set().union( *(self._lines(k) for k in keys) ) )
+
+      # Loop through each line containing any of the XML strings
+      for index in lines:
+         line = self.data[index]
+
+         # If one of the XML strings exists, replace the value
+         match = pattern.search(line)
+         if match is None or match.group(0) in done:
+            continue
+         xml_string = match.group(0)
+
+         # Determine start and stop index
+         start = line.find('>')
+         stop = line.rfind('<')
+
+         # Replace it in template
+         self.data[index] = line[:start+1] + replacements[xml_string] + line[stop:]
+         self._reindex(index, line)
+
+         # Only the first instance of this one
+         if xml_string in replace_one:
+            done.add(xml_string)
+
+      self._cached.clear()
 
    def insert(self, xml_after, insert_string, location):
       """ insert something after an element that exists in the list."""
 
       # x[index:index] = ['some','list']
 
-      # Loop through data and find index of matches
-      ind = []
-      for i, line in enumerate(self.data):
-         if xml_after in line:
-            ind.append(i)
+      # Find index of matches
+      ind = list( self._lines(xml_after) )
 
       # if no index found, ignore
       if len(ind) == 0:
@@ -117,9 +200,23 @@ class XML_Template:
 
       # Insert
       if type(insert_string) is list:
-         self.data[ind+1:ind+1] = insert_string
+         new_lines = list( insert_string )
       elif type(insert_string) is str:
-         self.data[ind+1:ind+1] = [ insert_string ]
+         new_lines = [ insert_string ]
+      self.data[ind+1:ind+1] = new_lines
+
+      # Shift the indexed lines after the insert, then index the new lines
+      for indices in self._index.values():
+         for k in range( bisect.bisect_right(indices, ind), len(indices) ):
+            indices[k] += len(new_lines)
+      for (index, line) in enumerate(new_lines, ind+1):
+         for tag in set( TAG_PATTERN.findall(line) ):
+            bisect.insort( self._index[tag], index )
+      self._cached.clear()
+
+   def has(self, xml_string):
+      """ check whether any line in the template contains xml_string """
+      return next( self._lines(xml_string), None ) is not None
 
    def read(self, xml_string, searchtype='first'):
       """ read a value from a key-value pair that exists on a single line
@@ -127,22 +224,20 @@ class XML_Template:
 
       val = []
 
-      # Loop through each line
-      for (index, line) in enumerate(self.data):
-
-         # If the XML string exists, replace the value
-         if xml_string in line:
+      # Loop through each line containing the XML string
+      for index in self._lines(xml_string):
+         line = self.data[index]
 
-            # Determine start and stop index
-            start = line.find('>')
-            stop = line.rfind('<')
+         # Determine start and stop index
+         start = line.find('>')
+         stop = line.rfind('<')
 
-            # Return the value
-            found_value = line[start+1:stop]
-            if searchtype=='first':
-               return found_value
-            else:
-               val.append( found_value )
+         # Return the value
+         found_value = line[start+1:stop]
+         if searchtype=='first':
+            return found_value
+         else:
+            val.append( found_value )
 
       if searchtype=='all':
          return val
@@ -151,14 +246,42 @@ class XML_Template:
       else:
          IOError('invalid argument `searchtype` into XML_Template.read, must be "first", "last", or "all"')
 
+   def read_cached(self, xml_string):
+      """ read the first value of xml_string, as read() does, and remember it
+          until the template is next modified """
+      if xml_string not in self._cached:
+         self._cached[xml_string] = self.read( xml_string )
+      return self._cached[xml_string]
+
    def write(self, out_filename):
-      """ write the template to file """
-      
-      fid = open(out_filename, 'w')
+      """ write the template to file. the label is written to a temporary
+          file next to it first and then moved into place, so a crash never
+          leaves a partially written label behind """
+
+      buf = memoryview( str(self).encode('utf-8') )
 
-      for line in self.data:
-         fid.write( line )
+      # Hand the whole label to the OS in one write, looping only if the
+      # write comes back short. the temporary file has a unique name in the
+      # label's directory, and is removed if anything goes wrong
+      fd, tmp_filename = tempfile.mkstemp( dir=os.path.dirname(os.path.abspath(out_filename)), suffix='.tmp' )
+      try:
+         try:
+            while buf:
+               buf = buf[ os.write(fd, buf): ]
+         finally:
+            os.close(fd)
 
-      fid.close()
+         # Keep the mode of an existing label, otherwise use the usual mode for a new file
+         if os.path.exists( out_filename ):
+            shutil.copymode( out_filename, tmp_filename )
+         else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod( tmp_filename, 0o666 & ~umask )
+         os.replace( tmp_filename, out_filename )
+      except BaseException:
+         if os.path.exists( tmp_filename ):
+            os.remove( tmp_filename )
+         raise
 
 # ---------------------------------------------------------------------------
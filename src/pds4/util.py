@@ -50,52 +50,202 @@ Last Modified: 14-SEP-2023
 """
 
 import os
+import mmap
+import hashlib
 from hashlib import md5
 import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
+
+# blake3 is optional, and only needed for blake3 file hashes
+try:
+   import blake3
+except ImportError:
+   blake3 = None
+
+# hash algorithms understood by new_hash and file_hash
+HASH_ALGORITHMS = ('md5', 'blake3')
+
+# slice size when hashing a mapped file
+MMAP_HASH_BLOCKSIZE = 1 << 24
+
+# files at least this large are hashed with a read-ahead thread, in blocks of this size
+READAHEAD_MINSIZE = 1 << 26
+READAHEAD_BLOCKSIZE = 1 << 24
 
 # ---------------------------------------------------------------------------
-def label_filename( filename ):
-   """ generate a label filename based on the TNF file name """
-   return os.path.split( os.path.abspath(filename) )[0] + \
+def label_filename( filename, basename=None, abspath=None ):
+   """ generate a label filename based on the TNF file name. the base name
+       and absolute path of the file can be passed in if already known """
+   if basename is None:
+      basename = os.path.basename( filename )
+   if abspath is None:
+      abspath = os.path.abspath( filename )
+   return os.path.split( abspath )[0] + \
           os.sep + \
-          os.path.basename( filename ).split('.')[0] + '.xml'
+          basename.split('.')[0] + '.xml'
 
 # ---------------------------------------------------------------------------
 
 # ---------------------------------------------------------------------------
-def md5hashfile(filename, blocksize=65536):
-   """ return the md5 hash of a file """
-   
-   # open file and start hasher
-   file = open(filename, 'rb')
-   hasher = md5()
-
-   # block-by-block create the hash
-   buf = file.read(blocksize)
-   while len(buf) > 0:
-      hasher.update(buf)
-      buf = file.read(blocksize)
-
-   # close file and return
-   file.close()
+def new_hash(algo='md5'):
+   """ return a new hash object for the named algorithm, 'md5' or 'blake3' """
+   if algo == 'md5':
+      return md5()
+   if algo == 'blake3':
+      if blake3 is None:
+         raise ImportError('the blake3 package is required for blake3 file hashes')
+      return blake3.blake3()
+   raise ValueError('invalid hash algorithm "%s", must be one of %s' % (algo, ', '.join(HASH_ALGORITHMS)))
+
+def file_hash(filename, algo='md5', blocksize=1<<20):
+   """ return the hash of a file as a hex string. instead of a file name,
+       this also accepts an open binary file (hashed from its current
+       position) or a buffer holding the file contents, such as an mmap
+       of the file """
+
+   # buffers are hashed in one go, without chunking on the python side
+   if isinstance(filename, (bytes, bytearray, memoryview, mmap.mmap)):
+      hasher = new_hash(algo)
+      hasher.update(filename)
+      return hasher.hexdigest()
+
+   if hasattr(filename, 'read'):
+      return _hash_fileobj(filename, algo, blocksize)
+   with open(filename, 'rb', buffering=0) as file:
+      return _hash_fileobj(file, algo, blocksize)
+
+def _hash_fileobj(file, algo, blocksize):
+   """ hash an open binary file, read and hashed in C on python 3.11+ """
+
+   # Tell the kernel the file is read front to back, so it reads ahead aggressively
+   if hasattr(os, 'posix_fadvise'):
+      try:
+         os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+      except (OSError, ValueError):
+         pass
+
+   # Large files: overlap reading and hashing
+   try:
+      remaining = os.fstat(file.fileno()).st_size - file.tell()
+   except (OSError, ValueError):
+      remaining = 0
+   if remaining >= READAHEAD_MINSIZE:
+      return _hash_readahead(file, algo, READAHEAD_BLOCKSIZE)
+
+   # file_digest reads in 256 KiB blocks unless told otherwise through its
+   # (private) _bufsize argument, so hand it our block size
+   if hasattr(hashlib, 'file_digest'):
+      try:
+         digest = hashlib.file_digest(file, lambda: new_hash(algo), _bufsize=blocksize)
+      except TypeError:
+         digest = hashlib.file_digest(file, lambda: new_hash(algo))
+      return digest.hexdigest()
+
+   # older pythons: hash a read-only mapping of the file in large slices,
+   # which are views into the page cache rather than copies
+   hasher = new_hash(algo)
+   try:
+      mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+   except (OSError, ValueError):
+      mm = None   # empty file, or not a regular file
+   if mm is not None:
+      with mm, memoryview(mm) as view:
+         for offset in range(file.tell(), len(mm), MMAP_HASH_BLOCKSIZE):
+            hasher.update(view[offset:offset+MMAP_HASH_BLOCKSIZE])
+      return hasher.hexdigest()
+
+   # otherwise block-by-block into a reused buffer
+   buf = bytearray(blocksize)
+   view = memoryview(buf)
+   n = file.readinto(buf)
+   while n:
+      hasher.update(view[:n])
+      n = file.readinto(buf)
+   return hasher.hexdigest()
+
+def _hash_readahead(file, algo, blocksize):
+   """ hash an open binary file while a worker thread reads the next block.
+       file reads and hashlib both release the GIL, so the disk and the hash
+       work in parallel instead of taking turns """
+
+   hasher = new_hash(algo)
+   with ThreadPoolExecutor(max_workers=1) as pool:
+      pending = pool.submit(file.read, blocksize)
+      buf = pending.result()
+      while buf:
+         pending = pool.submit(file.read, blocksize)
+         hasher.update(buf)
+         buf = pending.result()
    return hasher.hexdigest()
 
+def md5hashfile(filename, blocksize=1<<20):
+   """ return the md5 hash of a file, see file_hash """
+   return file_hash(filename, 'md5', blocksize)
+
 # ---------------------------------------------------------------------------
 
-def NLtoCRLF(filename,copyfile=False):
-   """ convert a text file from new-line (unix) to carrage-return line-feed (windows) """
+def extract_tags(filename, tags):
+   """ read the values of several tags from an XML file in a single pass.
+       returns a dict of {tag: text} for the first instance of each tag,
+       matched without its namespace, e.g. ('logical_identifier', 'version_id').
+       parsing stops as soon as every tag has been found """
+
+   found = {}
+   with open(filename, 'rb') as f:
+      for event, elem in ElementTree.iterparse(f, events=('end',)):
+         tag = elem.tag.rsplit('}', 1)[-1]
+         if tag in tags and tag not in found:
+            found[tag] = elem.text
+            if len(found) == len(tags):
+               break
+
+         # Keep memory flat for large labels
+         elem.clear()
 
-   # copy file first if we need to
-   if copyfile:
-      shutil.move( filename, filename + '.originalNL' )
+   return found
+
+# ---------------------------------------------------------------------------
 
-   # load file
-   with open(filename, 'r') as f:
-      data = f.read()
+def NLtoCRLF(filename,copyfile=False,blocksize=1<<20):
+   """ convert a text file from new-line (unix) to carrage-return line-feed (windows).
+       the file is streamed in blocks, so memory use does not grow with the file """
 
-   # replace
-   data2 = data.replace('\n','\r\n')
+   # translate into a temporary file next to the original. every line ending
+   # (CRLF, CR or LF) becomes CRLF, and a CR at the end of a block is held
+   # back in case its LF starts the next block. the temporary file has a
+   # unique name, and is removed if anything goes wrong
+   fd, tmp_filename = tempfile.mkstemp( dir=os.path.dirname(os.path.abspath(filename)), suffix='.tmp' )
+   try:
+      with open(filename, 'rb') as fin, open(fd, 'wb') as fout:
+         carry = b''
+         while True:
+            block = fin.read(blocksize)
+            if not block:
+               break
+            block = carry + block
+            if block.endswith(b'\r'):
+               block, carry = block[:-1], b'\r'
+            else:
+               carry = b''
+            fout.write( block.replace(b'\r\n', b'\n').replace(b'\r', b'\n').replace(b'\n', b'\r\n') )
+         if carry:
+            fout.write( b'\r\n' )
+      shutil.copymode( filename, tmp_filename )
 
-   # write file
-   with open(filename, 'w') as f:
-      f.write(data2) 
+      # keep the original file if we need to (as a link or copy, so the file
+      # stays in place until the new one replaces it), then move the new one in
+      if copyfile:
+         original_filename = filename + '.originalNL'
+         if os.path.exists( original_filename ):
+            os.remove( original_filename )
+         try:
+            os.link( filename, original_filename )
+         except OSError:
+            shutil.copy2( filename, original_filename )
+      os.replace( tmp_filename, filename )
+   except BaseException:
+      if os.path.exists( tmp_filename ):
+         os.remove( tmp_filename )
+      raise